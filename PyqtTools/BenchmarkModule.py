@@ -0,0 +1,304 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Throughput benchmark of the demodulation engines of DemodModule.
+
+Amplitude modulated multi-carrier signals are synthesized with a known
+envelope and demodulated headlessly, block by block, with any engine
+(DemodModes, the legacy Demod instances, PoolDemod or a DemodThread).
+For each engine it reports the throughput (MSamples/s), the real-time
+factor, the per-block latency percentiles and the error of the
+demodulated amplitude against the envelope.
+
+Command line:
+    DemodBenchmark --rows 16 --carriers 2 --modes Filter Boxcar FFT
+"""
+
+import time
+import argparse
+
+import numpy as np
+
+from PyqtTools.DemodModule import (Demod, DemodModes, PoolDemod,
+                                   DemodThread)
+
+
+def GetCarriers(Fs, DSFact, nCarriers):
+    ''' Returns nCarriers frequencies evenly spaced below Fs/4, all of
+        them on a bin of the DSFact group (see BoxcarDemod)
+    '''
+    DSFs = Fs/DSFact
+    Step = max(np.floor(Fs/4/(nCarriers + 1)/DSFs), 1)*DSFs
+    return [Step*(i + 1) for i in range(nCarriers)]
+
+
+class AMSignal():
+    def __init__(self, Fs, nRows, Fcs, ModFreq=10.0, ModDepth=0.5,
+                 Noise=0.0, Seed=0):
+        ''' Generator of amplitude modulated signals. Each row is the sum
+            of all the carriers, every channel (row, carrier) with its own
+            amplitude, phase and modulation phase:
+            Amp*(1 + ModDepth*sin(2*pi*ModFreq*t + ModPhase))*
+            cos(2*pi*Fc*t + Phase)
+            Fs: float. Sampling frequency
+            nRows: int. Number of rows
+            Fcs: list. Carrier frequencies
+            ModFreq: float. Modulating frequency, it must be well below
+                            the demodulation output rate
+            ModDepth: float. Modulation depth
+            Noise: float. Standard deviation of the added white noise
+        '''
+        self.Fs = Fs
+        self.nRows = nRows
+        self.Fcs = np.array(Fcs, dtype=float)
+        self.ModFreq = ModFreq
+        self.ModDepth = ModDepth
+        self.Noise = Noise
+        Rand = np.random.default_rng(Seed)
+        # (nRows, nCarriers), channel order of the engines
+        self.Amps = Rand.uniform(0.5, 1.5, (nRows, self.Fcs.size))
+        self.Phases = Rand.uniform(-np.pi, np.pi, (nRows, self.Fcs.size))
+        self.ModPhases = Rand.uniform(-np.pi, np.pi, (nRows, self.Fcs.size))
+        self.Rand = Rand
+        self.Ind = 0
+
+    def GetEnvelope(self, Times):
+        ''' Returns the amplitude of every channel (len(Times),
+            nRows*nCarriers) at Times
+        '''
+        Env = self.Amps*(1 + self.ModDepth *
+                         np.sin(2*np.pi*self.ModFreq*Times[:, None, None] +
+                                self.ModPhases))
+        return Env.reshape((Times.size, -1))
+
+    def GetBlock(self, nSamps):
+        ''' Returns the next nSamps samples (nSamps, nRows)
+        '''
+        Times = (self.Ind + np.arange(nSamps))/self.Fs
+        self.Ind += nSamps
+        Carriers = np.cos(2*np.pi*self.Fcs[None, None, :] *
+                          Times[:, None, None] + self.Phases)
+        Env = self.GetEnvelope(Times).reshape(Carriers.shape)
+        Block = np.sum(Env*Carriers, axis=2)
+        if self.Noise > 0:
+            Block += self.Noise*self.Rand.standard_normal(Block.shape)
+        return Block
+
+
+class LegacyDemod():
+    def __init__(self, Fcs, nRows, FetchSize, Fs, DownFact, Order=2,
+                 **kwargs):
+        ''' One Demod instance per row and carrier, as the demodulation
+            was done originally. Reference for the benchmarks.
+        '''
+        self.Fcs = Fcs
+        self.Demods = [Demod(Fc, FetchSize, Fs, DownFact, Order)
+                       for r in range(nRows) for Fc in Fcs]
+
+    def Apply(self, SigInput):
+        nCarriers = len(self.Fcs)
+        Out = [dem.Apply(SigInput[:, i//nCarriers])
+               for i, dem in enumerate(self.Demods)]
+        return np.array(Out).T
+
+
+def _EnvelopeError(Amp, Env, MaxLag):
+    # Relative RMS error of the demodulated amplitude, the filter delay is
+    # compensated with the integer lag (in output samples) that fits best
+    Errors = []
+    for Lag in range(MaxLag + 1):
+        Diff = Amp[Lag:, :] - Env[:Env.shape[0] - Lag, :]
+        Errors.append(np.sqrt(np.mean(Diff**2)))
+    return min(Errors)/np.mean(Env), int(np.argmin(Errors))
+
+
+def BenchDemod(Fs=2e6, nRows=8, Fcs=None, nCarriers=2, FetchSize=20000,
+               DSFact=100, FiltOrder=2, DemodMode='Filter', nWorkers=0,
+               nBlocks=50, nWarm=5, Noise=0.0, dtype='float64', **kwargs):
+    ''' Demodulates nBlocks synthetic blocks with one engine and returns
+        a dictionary with the results:
+        {'DemodMode': 'Filter',
+         'MSamplesPerSec': 210.3,  # input samples of all the rows
+         'RealTimeFactor': 12.6,   # > 1 when faster than acquisition
+         'LatencyP50': 1.3,        # ms, per block
+         'LatencyP90': 1.5,
+         'LatencyP99': 2.1,
+         'LatencyMax': 2.2,
+         'EnvError': 0.002,        # relative RMS error of the amplitude
+         'Lag': 3}                 # output samples of filter delay
+        Fs, nRows, FetchSize, DSFact, FiltOrder, dtype: acquisition and
+            demodulation settings, as in DemodThread
+        Fcs: list. Carrier frequencies, GetCarriers(nCarriers) if None
+        DemodMode: str. Key of DemodModes or 'Legacy'
+        nWorkers: int. If > 0, the engine is run in PoolDemod ('Legacy'
+                       can not be)
+        nBlocks: int. Blocks timed
+        nWarm: int. Blocks demodulated before timing, not used either for
+                    the envelope error
+        Other keywords are passed to the engine.
+    '''
+    if DemodMode == 'Legacy' and nWorkers > 0:
+        raise ValueError('The Legacy mode can not run in PoolDemod')
+    if Fcs is None:
+        Fcs = GetCarriers(Fs, DSFact, nCarriers)
+    EngineKwargs = dict(kwargs)
+    EngineKwargs.update({'Fcs': list(Fcs),
+                         'nRows': nRows,
+                         'FetchSize': FetchSize,
+                         'Fs': Fs,
+                         'DownFact': DSFact,
+                         'Order': FiltOrder,
+                         'dtype': dtype})
+    if nWorkers > 0:
+        Engine = PoolDemod(nWorkers=nWorkers, DemodMode=DemodMode,
+                           **EngineKwargs)
+    elif DemodMode == 'Legacy':
+        Engine = LegacyDemod(**EngineKwargs)
+    else:
+        Engine = DemodModes[DemodMode](**EngineKwargs)
+
+    # The blocks are generated one at a time, out of the timing, so the
+    # memory does not grow with nBlocks
+    Gen = AMSignal(Fs, nRows, Fcs, Noise=Noise)
+    Latency = []
+    Amps = []
+    try:
+        for i in range(nWarm + nBlocks):
+            Block = Gen.GetBlock(FetchSize).astype(dtype)
+            Start = time.perf_counter()
+            Out = Engine.Apply(Block)
+            Stop = time.perf_counter()
+            if i >= nWarm:
+                Latency.append(Stop - Start)
+                Amps.append(2*np.abs(Out))
+    finally:
+        if nWorkers > 0:
+            Engine.Close()
+
+    Amps = np.concatenate(Amps, axis=0)
+    Times = (nWarm*FetchSize + np.arange(Amps.shape[0])*DSFact)/Fs
+    EnvError, Lag = _EnvelopeError(Amps, Gen.GetEnvelope(Times),
+                                   MaxLag=min(50, Amps.shape[0]//2))
+    return _Summary(DemodMode, np.array(Latency), nRows, FetchSize, Fs,
+                    EnvError, Lag)
+
+
+def BenchDemodThread(Fs=2e6, nRows=8, Fcs=None, nCarriers=2,
+                     FetchSize=20000, DSFact=100, FiltOrder=2, nBlocks=50,
+                     Gain=1.0, **kwargs):
+    ''' Same as BenchDemod for a running DemodThread, the latency is the
+        time from AddData to the NewData signal, including the queue.
+        The blocks are added one at a time so the latency is not
+        accumulated in the queue. No event loop is needed, NewData is
+        connected directly.
+        Other keywords (DemodMode, nWorkers, dtype...) are passed to
+        DemodThread.
+    '''
+    import threading
+    from PyQt5 import Qt
+
+    if Fcs is None:
+        Fcs = GetCarriers(Fs, DSFact, nCarriers)
+    ColFcs = {'Col{}'.format(i): Fc for i, Fc in enumerate(Fcs)}
+    RowList = ['Ch{0:02d}'.format(i) for i in range(nRows)]
+    Thread = DemodThread(ColFcs, RowList, FetchSize, Fs, DSFact, FiltOrder,
+                         None, Gain, **kwargs)
+    Done = threading.Event()
+    Amps = []
+
+    def on_NewData():
+        Amps.append(np.abs(Thread.OutDemodData*Gain))
+        Done.set()
+
+    Thread.NewData.connect(on_NewData, Qt.Qt.DirectConnection)
+    Gen = AMSignal(Fs, nRows, Fcs)
+    Thread.start()
+    Latency = []
+    try:
+        for i in range(nBlocks):
+            Block = Gen.GetBlock(FetchSize)
+            Done.clear()
+            Start = time.perf_counter()
+            Thread.AddData(Block)
+            Done.wait()
+            Latency.append(time.perf_counter() - Start)
+    finally:
+        Thread.stop()
+        Thread.wait()
+
+    Amps = np.concatenate(Amps, axis=0)
+    Times = np.arange(Amps.shape[0])*DSFact/Fs
+    Skip = Amps.shape[0]//10
+    EnvError, Lag = _EnvelopeError(Amps[Skip:], Gen.GetEnvelope(Times[Skip:]),
+                                   MaxLag=min(50, Amps.shape[0]//4))
+    return _Summary('Thread', np.array(Latency), nRows, FetchSize, Fs,
+                    EnvError, Lag)
+
+
+def _Summary(Name, Latency, nRows, FetchSize, Fs, EnvError, Lag):
+    Mean = np.mean(Latency)
+    return {'DemodMode': Name,
+            'MSamplesPerSec': nRows*FetchSize/Mean/1e6,
+            'RealTimeFactor': FetchSize/Fs/Mean,
+            'LatencyP50': 1e3*np.percentile(Latency, 50),
+            'LatencyP90': 1e3*np.percentile(Latency, 90),
+            'LatencyP99': 1e3*np.percentile(Latency, 99),
+            'LatencyMax': 1e3*np.max(Latency),
+            'EnvError': EnvError,
+            'Lag': Lag}
+
+
+def PrintResults(Results):
+    Cols = ('DemodMode', 'MSamplesPerSec', 'RealTimeFactor', 'LatencyP50',
+            'LatencyP90', 'LatencyP99', 'LatencyMax', 'EnvError')
+    print(' '.join('{:>14}'.format(c) for c in Cols))
+    for Res in Results:
+        print('{:>14}'.format(Res['DemodMode']) +
+              ''.join(' {:>14.4g}'.format(Res[c]) for c in Cols[1:]))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Demodulation throughput '
+                                     'benchmark with synthetic AM signals')
+    parser.add_argument('--fs', type=float, default=2e6)
+    parser.add_argument('--rows', type=int, default=8)
+    parser.add_argument('--carriers', type=int, default=2)
+    parser.add_argument('--fcs', type=float, nargs='+', default=None)
+    parser.add_argument('--fetch', type=int, default=20000)
+    parser.add_argument('--dsfact', type=int, default=100)
+    parser.add_argument('--order', type=int, default=2)
+    parser.add_argument('--modes', nargs='+',
+                        default=list(DemodModes.keys()),
+                        choices=list(DemodModes.keys()) + ['Legacy',
+                                                           'Thread'])
+    parser.add_argument('--workers', type=int, default=0)
+    parser.add_argument('--blocks', type=int, default=50)
+    parser.add_argument('--noise', type=float, default=0.0)
+    parser.add_argument('--dtype', default='float64',
+                        choices=['float64', 'float32'])
+    args = parser.parse_args(argv)
+    if 'Legacy' in args.modes and args.workers > 0:
+        parser.error('the Legacy mode can not be used with --workers')
+
+    Conf = {'Fs': args.fs,
+            'nRows': args.rows,
+            'Fcs': args.fcs,
+            'nCarriers': args.carriers,
+            'FetchSize': args.fetch,
+            'DSFact': args.dsfact,
+            'FiltOrder': args.order,
+            'nBlocks': args.blocks,
+            'dtype': args.dtype,
+            'nWorkers': args.workers}
+    Results = []
+    for Mode in args.modes:
+        if Mode == 'Thread':
+            Results.append(BenchDemodThread(**Conf))
+        else:
+            Results.append(BenchDemod(DemodMode=Mode, Noise=args.noise,
+                                      **Conf))
+    PrintResults(Results)
+
+
+if __name__ == '__main__':
+    main()
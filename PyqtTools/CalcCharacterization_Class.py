@@ -74,8 +74,11 @@ class StbDetThread(Qt.QThread):
                                             FsDemod=PlotterDemodKwargs['Fs']
                                             )
         if self.ACenable:
+            # Pyxi CalcPSD only takes the Welch parameters
+            PSDKwargs = {k: PlotterDemodKwargs[k]
+                         for k in ('Fs', 'nFFT', 'nAvg', 'scaling')}
             self.threadCalcPSD = PSD.CalcPSD(nChannels=nChannels,
-                                         **PlotterDemodKwargs)
+                                             **PSDKwargs)
             self.threadCalcPSD.PSDDone.connect(self.on_PSDDone)
             self.SaveDCAC.PSDSaved.connect(self.on_NextVgs)
             
@@ -84,7 +87,7 @@ class StbDetThread(Qt.QThread):
 
     def run(self):
         while True:
-            if self.Buffer.IsFilled():
+            if self.Buffer.WaitFilled(PltBuffer2D.WaitTimeout):
                 Data = self.Buffer
                 ChnInd = 0
                 Dev = np.ndarray((Data.shape[1],))
@@ -107,9 +110,6 @@ class StbDetThread(Qt.QThread):
 
                 self.Buffer.Reset()
 
-            else:
-                Qt.QThread.msleep(10)
-
 
     def AddData(self, NewData):
         if self.Stable is False:
@@ -7,7 +7,6 @@ Created on Fri Jun 26 08:17:10 2020
 
 import numpy as np
 import pickle
-from scipy.signal import welch
 
 import pyqtgraph.parametertree.parameterTypes as pTypes
 
@@ -223,6 +222,7 @@ class StbDetThread(Qt.QThread):
                                            'nAvg': 50 }
         '''
         super(StbDetThread, self).__init__()
+        self.Running = True
         self.threadCalcPSD = None
         self.ToStabData = None
         self.Stable = False
@@ -261,8 +261,8 @@ class StbDetThread(Qt.QThread):
             self.SaveDCAC.DCSaved.connect(self.on_NextVgs)
 
     def run(self):
-        while True:
-            if self.Buffer.IsFilled():
+        while self.Running:
+            if self.Buffer.WaitFilled(PltBuffer2D.WaitTimeout):
                 Data = self.Buffer
                 ChnInd = 0
                 Dev = np.ndarray((Data.shape[1],))
@@ -285,9 +285,6 @@ class StbDetThread(Qt.QThread):
 
                 self.Buffer.Reset()
 
-            else:
-                Qt.QThread.msleep(10)
-
 
     def AddData(self, NewData):
         if self.Stable is False:
@@ -373,52 +370,104 @@ class StbDetThread(Qt.QThread):
             self.SaveDCAC.PSDSaved.disconnect()
             self.threadCalcPSD.PSDDone.disconnect()
             self.threadCalcPSD.stop()
-        self.terminate()
+        # The loop ends after the calculation in process, terminate is
+        # only used if it does not finish in StopTimeout
+        self.Running = False
+        if not self.wait(int(PltBuffer2D.StopTimeout*1000)):
+            self.terminate()
+            self.wait()
         
 ################CALC PSD THREAD###############################################
         
 class CalcPSD(Qt.QThread):
     PSDDone = Qt.pyqtSignal()
-    def __init__(self, Fs, nFFT, nAvg, nChannels, scaling):
+    def __init__(self, Fs, nFFT, nAvg, nChannels, scaling, dtype=float,
+                 PSDMode='Welch', nFFTStage=10, **kwargs):
         '''Initialization of the thread that is used to calculate the PSD
            Fs: float. Sampling Frequency
            nFFT: float.
            nAvg: int.
            nChannels: int. Number of acquisition channels (rows) active
            scaling: str. Two options, Density or Spectrum
+           dtype: dtype of the buffer, float32 halves its memory
+           PSDMode: str. 'Welch' computes the PSD once the buffer is
+                         filled, 'Stream' or 'StreamExp' compute each
+                         segment as it arrives (PltBuffer2D.StreamPSD) and
+                         emit PSDDone when the same number of segments has
+                         been averaged. 'MultiRes' uses
+                         PltBuffer2D.MultiResPSD with segments of
+                         2**nFFTStage samples
+           nFFTStage: int. Segment length (2**x) of the MultiRes stages
         '''
         super(CalcPSD, self).__init__()
+        self.Running = True
 
         self.scaling = scaling
         self.nFFT = 2**nFFT
         self.nChannels = nChannels
         self.Fs = Fs
         self.BufferSize = self.nFFT * nAvg
+        if PSDMode == 'MultiRes':
+            self.BufferSize = min(self.BufferSize,
+                                  max(2**nFFTStage*nAvg, int(self.Fs)))
         self.Buffer = PltBuffer2D.Buffer2D(self.Fs, self.nChannels,
-                                           self.BufferSize/self.Fs)
+                                           self.BufferSize/self.Fs,
+                                           dtype=dtype)
+        self.PSDMode = PSDMode
+        self.Engine = PltBuffer2D.GetPSDEngine(self.Fs, self.nFFT, scaling)
+        if PSDMode == 'MultiRes':
+            self.Stream = PltBuffer2D.MultiResPSD(
+                self.Fs, 2**nFFTStage, self.nChannels,
+                nStages=max(nFFT - nFFTStage, 0) + 1, nAvg=nAvg,
+                scaling=scaling)
+        elif PSDMode != 'Welch':
+            self.Stream = PltBuffer2D.StreamPSD(
+                self.Fs, self.nFFT, self.nChannels, nAvg=nAvg,
+                scaling=scaling,
+                Average='Exp' if PSDMode == 'StreamExp' else 'Mean')
+
+    def start(self, *args, **kwargs):
+        # The thread is started again for each bias point after stop
+        self.Running = True
+        super(CalcPSD, self).start(*args, **kwargs)
 
     def run(self, *args, **kwargs):
-        while True:
-            if self.Buffer.IsFilled():
-                self.ff, self.psd = welch(self.Buffer,
-                                          fs=self.Fs,
-                                          nperseg=self.nFFT,
-                                          scaling=self.scaling,
-                                          axis=0)
+        while self.Running:
+            if self.PSDMode != 'Welch':
+                if self.Buffer.WaitData(self.Stream.Step,
+                                        PltBuffer2D.WaitTimeout):
+                    Data, Lost = self.Buffer.PopNew()
+                    if Lost:
+                        self.Stream.DropPending()
+                    self.Stream.AddData(Data)
+                    if self.Stream.IsFilled():
+                        self.ff, self.psd = self.Stream.GetPSD()
+                        self.Stream.Reset()
+                        self.PSDDone.emit()
+                else:
+                    Qt.QCoreApplication.processEvents()
+            elif self.Buffer.WaitFilled(PltBuffer2D.WaitTimeout):
+                self.ff, self.psd = self.Engine.Welch(self.Buffer.GetData())
 #                print('PSD DONE EMIT')
                 self.Buffer.Reset()
                 self.PSDDone.emit()
 
             else:
                 Qt.QCoreApplication.processEvents()
-                Qt.QThread.msleep(200)
 
     def AddData(self, NewData):
         self.Buffer.AddData(NewData)
 
     def stop(self):
+        # The loop ends after the calculation in process, terminate is
+        # only used if it does not finish in StopTimeout
+        self.Running = False
+        if not self.wait(int(PltBuffer2D.StopTimeout*1000)):
+            self.terminate()
+            self.wait()
         self.Buffer.Reset()
-        self.terminate()
+        if self.PSDMode != 'Welch':
+            self.Stream.Reset()
 
 ################SAVE CHARACTERIZATION DICTs###################################
         
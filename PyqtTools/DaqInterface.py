@@ -44,9 +44,17 @@ class ReadAnalog(Daq.Task):
     EveryNEvent = None
     DoneEvent = None
 
-    def __init__(self, InChans, Range=5.0, Diff=False):
+    def __init__(self, InChans, Range=5.0, Diff=False, dtype='float64'):
+        ''' InChans: list. Names of the analog inputs
+            Range: float. Input range (V)
+            Diff: bool. Differential or referenced single ended inputs
+            dtype: str. dtype of the blocks passed to EveryNEvent. DAQmx
+                        always reads float64, with 'float32' each block
+                        is read into a reused buffer and converted.
+        '''
         Daq.Task.__init__(self)
         self.Channels = InChans
+        self.dtype = np.dtype(dtype)
 
         Dev = GetDevName()
         for Ch in self.Channels:
@@ -73,6 +81,8 @@ class ReadAnalog(Daq.Task):
                               self.EverySamps)
 
         self.CfgInputBuffer(self.EverySamps*10)
+        if self.dtype != np.float64:
+            self.ReadBuffer = np.zeros((self.EverySamps, len(self.Channels)))
         self.AutoRegisterEveryNSamplesEvent(Daq.DAQmx_Val_Acquired_Into_Buffer,
                                             self.EverySamps, 0)
 
@@ -85,10 +95,15 @@ class ReadAnalog(Daq.Task):
     def EveryNCallback(self):
 #        print('Every')
         read = c_int32()
-        data = np.zeros((self.EverySamps, len(self.Channels)))
+        if self.dtype == np.float64:
+            data = np.zeros((self.EverySamps, len(self.Channels)))
+        else:
+            data = self.ReadBuffer
         self.ReadAnalogF64(self.EverySamps, 10.0,
                            Daq.DAQmx_Val_GroupByScanNumber,
                            data, data.size, byref(read), None)
+        if self.dtype != np.float64:
+            data = data.astype(self.dtype)
 
 #        print('EveryN')
 
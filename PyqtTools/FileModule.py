@@ -14,6 +14,8 @@ import os
 import pickle
 import numpy as np
 
+from PyqtTools.QueueModule import BlockQueue
+
 
 SaveFilePars = [{'name': 'Save File',
                  'type': 'action'},
@@ -53,7 +55,12 @@ class SaveFileParameters(pTypes.GroupParameter):
 
 
 class FileBuffer():
-    def __init__(self, FileName, MaxSize, nChannels, Fs=None, ChnNames=None):
+    def __init__(self, FileName, MaxSize, nChannels, Fs=None, ChnNames=None,
+                 dtype='f4'):
+        ''' dtype: dtype of the 'data' dataset, the default 'f4' (float32)
+                   is the h5py default used so far
+        '''
+        self.dtype = dtype
         self.FileBase = FileName.split('.h5')[0]
         self.PartCount = 0
         self.nChannels = nChannels
@@ -81,6 +88,7 @@ class FileBuffer():
         self.Dset = self.h5File.create_dataset('data',
                                                shape=(0, self.nChannels),
                                                maxshape=(None, self.nChannels),
+                                               dtype=self.dtype,
                                                compression="gzip")
 
     def AddSample(self, Sample):
@@ -91,38 +99,50 @@ class FileBuffer():
         self.h5File.flush()
 
         stat = os.stat(self.FileName)
-        if stat.st_size > self.MaxSize:
+        if self.MaxSize is not None and stat.st_size > self.MaxSize:
 #            print(stat.st_size, self.MaxSize)
             self._initFile()
 
 
 class DataSavingThread(Qt.QThread):
     def __init__(self, FileName, nChannels, Fs=None, ChnNames=None, 
-                 MaxSize=None, dtype='float'):
+                 MaxSize=None, dtype='f4', QueueDepth=8,
+                 QueuePolicy='DropOldest', StopTimeout=5.0):
+        ''' StopTimeout: float. Time (s) that stop waits for the pending
+                         blocks to be written before terminating the thread
+        '''
         super(DataSavingThread, self).__init__()
-        self.NewData = None
+        self.StopTimeout = StopTimeout
+        self.Running = True
+        self.Queue = BlockQueue(Depth=QueueDepth, Policy=QueuePolicy)
         self.FileBuff = FileBuffer(FileName=FileName,
                                    nChannels=nChannels,
                                    MaxSize=MaxSize,
                                    Fs=Fs,
-                                   ChnNames=ChnNames)
+                                   ChnNames=ChnNames,
+                                   dtype=dtype)
 
     def run(self, *args, **kwargs):
-        while True:
-            if self.NewData is not None:
-                self.FileBuff.AddSample(self.NewData)
-                self.NewData = None
-            else:
-                Qt.QThread.msleep(10)
+        # After stop the pending blocks are still written
+        while self.Running or self.Queue.Level():
+            NewData = self.Queue.Get(Timeout=0.1)
+            if NewData is not None:
+                self.FileBuff.AddSample(NewData)
 
     def AddData(self, NewData):
-        if self.NewData is not None:
-            print('Error Saving !!!!')
-        self.NewData = NewData
-    
-    def stop (self):
+        if not self.Queue.Put(NewData):
+            print('Error Saving !!!!', self.Queue.GetCounters())
+
+    def stop(self):
+        # The file is closed once the loop has written the pending blocks,
+        # terminate is only used if it does not finish in StopTimeout
+        self.Running = False
+        if not self.wait(int(self.StopTimeout*1000)):
+            print('Saving not finished, pending blocks lost',
+                  self.Queue.GetCounters())
+            self.terminate()
+            self.wait()
         self.FileBuff.h5File.close()
-        self.terminate()
 
 
 
@@ -0,0 +1,322 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Offline demodulation of raw recordings saved with FileModule.FileBuffer.
+
+The recording (all its _N.h5 parts) is read chunk by chunk and processed
+with the engines of DemodModule, so the filter state is carried between
+chunks and the file is never loaded in memory. The recording can also be
+split in time segments that are demodulated in parallel processes, each
+one starting some samples before its segment to let the filters settle.
+
+Command line:
+    OfflineDemod Rec.h5 RecDemod.h5 --fc Col1=30e3 --fc Col2=50e3 --dsfact 100
+"""
+
+import os
+import re
+import glob
+import argparse
+import multiprocessing
+
+import h5py
+import numpy as np
+
+from PyqtTools.DemodModule import DemodModes, CalcOutput
+from PyqtTools.FileModule import FileBuffer
+
+
+def FindParts(FileName):
+    ''' Returns the list of files of a recording. If FileName is a part
+        (Rec_3.h5) or the base name of a recording with parts (Rec.h5 when
+        Rec_0.h5, Rec_1.h5 ... exist), all the parts are returned in order
+    '''
+    Base = FileName.split('.h5')[0]
+    Match = re.match(r'(.*)_(\d+)$', Base)
+    if Match is not None and os.path.exists(FileName):
+        Base = Match.group(1)
+    elif os.path.exists(Base + '.h5'):
+        return [Base + '.h5', ]
+
+    Parts = {}
+    for PartName in glob.glob(glob.escape(Base) + '_*.h5'):
+        Ind = PartName[len(Base)+1:-3]
+        if Ind.isdigit():
+            Parts[int(Ind)] = PartName
+    if not Parts:
+        raise FileNotFoundError(FileName)
+    return [Parts[i] for i in sorted(Parts)]
+
+
+class Recording():
+    def __init__(self, FileName):
+        ''' Raw recording of one or several FileBuffer parts seen as a
+            single (samples, channels) array.
+            FileName: str. Any file of the recording, see FindParts
+        '''
+        self.Files = FindParts(FileName)
+        self.h5Files = [h5py.File(f, 'r') for f in self.Files]
+        self.Dsets = [h5['data'] for h5 in self.h5Files]
+        Lengths = [Dset.shape[0] for Dset in self.Dsets]
+        # Index of the first sample of each part
+        self.Starts = np.concatenate(([0, ], np.cumsum(Lengths)))
+        self.nSamps = int(self.Starts[-1])
+        self.nChannels = self.Dsets[0].shape[1]
+
+        First = self.h5Files[0]
+        self.Fs = None
+        if 'Fs' in First:
+            self.Fs = float(First['Fs'][()])
+        if 'ChnNames' in First:
+            self.ChnNames = [n.decode() for n in First['ChnNames'][()]]
+        else:
+            self.ChnNames = ['Ch{0:02d}'.format(i)
+                             for i in range(self.nChannels)]
+
+    def Read(self, Start, Stop):
+        ''' Returns the samples from Start to Stop, joining parts if needed
+        '''
+        Stop = min(Stop, self.nSamps)
+        Pieces = []
+        for Dset, PartStart in zip(self.Dsets, self.Starts[:-1]):
+            PartStop = PartStart + Dset.shape[0]
+            if PartStop <= Start or PartStart >= Stop:
+                continue
+            Pieces.append(Dset[max(Start - PartStart, 0):
+                               min(Stop, PartStop) - PartStart, :])
+        if len(Pieces) == 1:
+            return Pieces[0]
+        return np.concatenate(Pieces, axis=0)
+
+    def Chunks(self, ChunkSize, Start=0, Stop=None):
+        ''' Generator of consecutive blocks of ChunkSize samples from Start
+            to Stop, the last one can be shorter
+        '''
+        if Stop is None:
+            Stop = self.nSamps
+        for Ind in range(Start, Stop, ChunkSize):
+            yield self.Read(Ind, min(Ind + ChunkSize, Stop))
+
+    def Close(self):
+        for h5 in self.h5Files:
+            h5.close()
+
+
+def _DemodSegment(Args):
+    # Demodulates the samples Start to Stop of the recording to OutFile.
+    # Processing starts at WarmStart, the outputs before Start are
+    # discarded. Runs in the worker processes for parallel segments.
+    InFile, OutFile, Start, Stop, WarmStart, Conf = Args
+    Rec = Recording(InFile)
+    Rows = Conf['Rows']
+    RowInds = [Rec.ChnNames.index(r) for r in Rows]
+    DSFact = Conf['DSFact']
+    ChunkSize = Conf['ChunkSize']
+    Fcs = Conf['Fcs']
+
+    Engine = DemodModes[Conf['DemodMode']](Fcs=list(Fcs.values()),
+                                           nRows=len(Rows),
+                                           FetchSize=ChunkSize,
+                                           Fs=Conf['Fs'],
+                                           DownFact=DSFact,
+                                           Order=Conf['FiltOrder'],
+                                           StartInd=WarmStart,
+                                           **Conf['EngineKwargs'])
+    if Conf['OutType'] == 'Complex':
+        OutDtype = np.result_type(Conf['dtype'], np.complex64)
+    else:
+        OutDtype = np.dtype(Conf['dtype'])
+    ChnNames = np.array([r + c for r in Rows for c in Fcs], dtype='S10')
+    OutBuff = FileBuffer(FileName=OutFile,
+                         MaxSize=None,
+                         nChannels=len(ChnNames),
+                         Fs=Conf['Fs']/DSFact,
+                         ChnNames=ChnNames,
+                         dtype=OutDtype)
+
+    nSkip = (Start - WarmStart)//DSFact
+    nOut = 0
+    for Chunk in Rec.Chunks(ChunkSize, WarmStart, Stop):
+        Chunk = Chunk[:, RowInds]
+        nValid = Chunk.shape[0]//DSFact
+        if nValid == 0:
+            break
+        if Chunk.shape[0] < ChunkSize:
+            # Last chunk, zero padded for the engines that need full blocks
+            Chunk = np.concatenate((Chunk,
+                                    np.zeros((ChunkSize - Chunk.shape[0],
+                                              Chunk.shape[1]),
+                                             dtype=Chunk.dtype)))
+        Dem = Engine.Apply(Chunk)[:nValid, :]
+        Out = CalcOutput(Dem, 2/Conf['Gain'], Conf['OutType'],
+                         np.empty(Dem.shape, dtype=OutDtype))
+        if nSkip >= Out.shape[0]:
+            nSkip -= Out.shape[0]
+            continue
+        Out = Out[nSkip:, :]
+        nSkip = 0
+        OutBuff.AddSample(Out)
+        nOut += Out.shape[0]
+
+    OutBuff.h5File.close()
+    Rec.Close()
+    return OutFile, nOut
+
+
+def OfflineDemod(InFile, OutFile, Fcs, DSFact, FiltOrder=2, Gain=1.0,
+                 Fs=None, Rows=None, ChunkSize=None, DemodMode='Filter',
+                 OutType='Complex', dtype='float64', nSegments=1,
+                 nWorkers=None, WarmUp=100, **kwargs):
+    ''' Demodulates a raw recording and saves the result in a new file with
+        the 'data', 'Fs' and 'ChnNames' datasets of FileBuffer.
+        InFile: str. Recording, any of its parts (see FindParts)
+        OutFile: str. Output file
+        Fcs: dictionary. Carrier frequency of each column, as DemodThread
+                         {'Col1': 30000.0}
+        DSFact: int. DownSampling Factor
+        FiltOrder: int. Order of the low-pass filter
+        Gain: float. The output is 2*demodulated/Gain, as in DemodThread
+        Fs: float. Sampling frequency, only needed if the recording does
+                   not have the 'Fs' dataset
+        Rows: list. Names of the recorded channels to demodulate, all of
+                    them if None
+        ChunkSize: int. Samples read and processed at once, rounded to a
+                        multiple of DSFact. About 1000 outputs if None
+        DemodMode: str. Engine, key of DemodModule.DemodModes
+        OutType: str. 'Complex', 'Real', 'Imag', 'Abs' or 'Angle'
+        dtype: str. Processing precision, 'float64' or 'float32'
+        nSegments: int. Number of time segments processed in parallel
+        nWorkers: int. Number of processes, nSegments limited to the
+                       number of CPUs if None
+        WarmUp: int. Output samples computed and discarded before each
+                     segment (except the first) to settle the filters
+        Other keywords (FiltForm, Decimation, nSlide...) are passed to the
+        engine.
+        Returns the number of output samples.
+    '''
+    Rec = Recording(InFile)
+    if Fs is None:
+        Fs = Rec.Fs
+    if Fs is None:
+        Rec.Close()
+        raise ValueError('The recording has no Fs, it must be given')
+    if Rows is None:
+        Rows = Rec.ChnNames
+    nSamps = Rec.nSamps
+    Rec.Close()
+
+    if ChunkSize is None:
+        ChunkSize = 1000*DSFact
+    ChunkSize = max(int(np.ceil(ChunkSize/DSFact)), 1)*DSFact
+    Conf = {'Fcs': Fcs,
+            'Rows': list(Rows),
+            'Fs': Fs,
+            'DSFact': DSFact,
+            'FiltOrder': FiltOrder,
+            'Gain': Gain,
+            'ChunkSize': ChunkSize,
+            'DemodMode': DemodMode,
+            'OutType': OutType,
+            'dtype': dtype,
+            'EngineKwargs': dict(kwargs, dtype=dtype)}
+
+    nOutTotal = nSamps//DSFact
+    nSegments = max(min(nSegments, nOutTotal//max(WarmUp, 1)), 1)
+    if nSegments == 1:
+        return _DemodSegment((InFile, OutFile, 0, nOutTotal*DSFact, 0,
+                              Conf))[1]
+
+    OutBase = OutFile.split('.h5')[0]
+    Bounds = np.linspace(0, nOutTotal, nSegments + 1).astype(int)*DSFact
+    Tasks = []
+    for iSeg in range(nSegments):
+        Start = int(Bounds[iSeg])
+        WarmStart = max(Start - WarmUp*DSFact, 0)
+        Tasks.append((InFile, '{}_seg{}.h5'.format(OutBase, iSeg),
+                      Start, int(Bounds[iSeg + 1]), WarmStart, Conf))
+
+    if nWorkers is None:
+        nWorkers = min(nSegments, os.cpu_count() or 1)
+    OutBuff = None
+    nOut = 0
+    Ctx = multiprocessing.get_context('spawn')
+    with Ctx.Pool(nWorkers) as Pool:
+        # Segments are merged in order as they are finished
+        for SegFile, _ in Pool.imap(_DemodSegment, Tasks):
+            with h5py.File(SegFile, 'r') as SegH5:
+                SegData = SegH5['data']
+                if OutBuff is None:
+                    OutBuff = FileBuffer(FileName=OutFile,
+                                         MaxSize=None,
+                                         nChannels=SegData.shape[1],
+                                         Fs=Fs/DSFact,
+                                         ChnNames=SegH5['ChnNames'][()],
+                                         dtype=SegData.dtype)
+                for Ind in range(0, SegData.shape[0], ChunkSize):
+                    OutBuff.AddSample(SegData[Ind:Ind + ChunkSize, :])
+                nOut += SegData.shape[0]
+            os.remove(SegFile)
+    OutBuff.h5File.close()
+    return nOut
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Demodulates a raw '
+                                     'recording saved with FileBuffer')
+    parser.add_argument('InFile', help='Recording, any of its _N.h5 parts')
+    parser.add_argument('OutFile', help='Output h5 file')
+    parser.add_argument('--fc', action='append', required=True,
+                        metavar='COL=FREQ',
+                        help='Column name and carrier frequency, repeat '
+                             'for each carrier')
+    parser.add_argument('--dsfact', type=int, required=True)
+    parser.add_argument('--order', type=int, default=2)
+    parser.add_argument('--gain', type=float, default=1.0)
+    parser.add_argument('--fs', type=float, default=None)
+    parser.add_argument('--rows', nargs='+', default=None)
+    parser.add_argument('--chunk', type=int, default=None)
+    parser.add_argument('--mode', default='Filter',
+                        choices=list(DemodModes.keys()))
+    parser.add_argument('--outtype', default='Complex',
+                        choices=['Complex', 'Real', 'Imag', 'Abs', 'Angle'])
+    parser.add_argument('--dtype', default='float64',
+                        choices=['float64', 'float32'])
+    parser.add_argument('--filtform', default='ba', choices=['ba', 'sos'])
+    parser.add_argument('--decimation', default='FullRate',
+                        choices=['FullRate', 'MultiStage'])
+    parser.add_argument('--nslide', type=int, default=4)
+    parser.add_argument('--window', default='Hann', choices=['Hann', 'Rect'])
+    parser.add_argument('--segments', type=int, default=1)
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--warmup', type=int, default=100)
+    args = parser.parse_args(argv)
+
+    Fcs = {}
+    for fc in args.fc:
+        Col, Freq = fc.split('=')
+        Fcs[Col] = float(Freq)
+
+    nOut = OfflineDemod(InFile=args.InFile,
+                        OutFile=args.OutFile,
+                        Fcs=Fcs,
+                        DSFact=args.dsfact,
+                        FiltOrder=args.order,
+                        Gain=args.gain,
+                        Fs=args.fs,
+                        Rows=args.rows,
+                        ChunkSize=args.chunk,
+                        DemodMode=args.mode,
+                        OutType=args.outtype,
+                        dtype=args.dtype,
+                        nSegments=args.segments,
+                        nWorkers=args.workers,
+                        WarmUp=args.warmup,
+                        FiltForm=args.filtform,
+                        Decimation=args.decimation,
+                        nSlide=args.nslide,
+                        Window=args.window)
+    print('{} samples saved in {}'.format(nOut, args.OutFile))
+
+
+if __name__ == '__main__':
+    main()
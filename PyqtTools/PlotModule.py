@@ -11,7 +11,10 @@ import pyqtgraph as pg
 import copy
 from PyQt5 import Qt
 import numpy as np
-from scipy.signal import welch
+import threading
+from numpy.lib.stride_tricks import sliding_window_view
+from scipy.signal import get_window, ellip, sosfilt
+from scipy import fft
 
 
 ChannelPars = {'name': 'Ch01',
@@ -68,6 +71,30 @@ PlotterPars = ({'name': 'Fs',
                {'name': 'Windows',
                 'type': 'int',
                 'value': 1},
+               {'name': 'MaxPoints',
+                'title': 'Max Points/Curve (0 Off)',
+                'type': 'int',
+                'limits': (0, 1e7),
+                'value': 0},
+               {'name': 'RenderMode',
+                'title': 'Render Mode',
+                'type': 'list',
+                'values': ['PerChannel', 'Packed'],
+                'value': 'PerChannel',
+                'tip': 'Packed draws each window as a single curve, all '
+                       'its channels with the color of the first one'},
+               {'name': 'ChannelOffset',
+                'title': 'Channel Offset',
+                'type': 'float',
+                'value': 0,
+                'siPrefix': True,
+                'suffix': 'A'},
+               {'name': 'MaxFps',
+                'title': 'Max Refresh Rate',
+                'type': 'float',
+                'limits': (0.1, 200),
+                'value': 25,
+                'suffix': 'fps'},
                {'name': 'Channels',
                 'type': 'group',
                 'children': []},)
@@ -144,43 +171,110 @@ class PgPlotWindow(Qt.QWidget):
 ##############################################################################
 
 
-class Buffer2D(np.ndarray):
-    def __new__(subtype, Fs, nChannels, ViewBuffer,
-                dtype=float, buffer=None, offset=0,
-                strides=None, order=None, info=None):
-        # Create the ndarray instance of our type, given the usual
-        # ndarray input arguments.  This will call the standard
-        # ndarray constructor, but return an object of our type.
-        # It also triggers a call to InfoArray.__array_finalize__
+class Buffer2D():
+    def __init__(self, Fs, nChannels, ViewBuffer, dtype=float):
+        ''' Circular buffer of samples x channels.
+            New blocks are written in place over the oldest samples, so
+            AddData only copies the new data. Reading (indexing, np.asarray,
+            GetData) returns the samples in chronological order, as a view
+            when the requested rows do not cross the wrap point.
+            Fs: float. Sampling frequency of the stored data
+            nChannels: int. Number of channels (columns)
+            ViewBuffer: float. Length of the buffer in seconds
+            dtype: data type of the stored samples
+        '''
         BufferSize = int(ViewBuffer*Fs)
-        shape = (BufferSize, nChannels)
-        obj = super(Buffer2D, subtype).__new__(subtype, shape, dtype,
-                                               buffer, offset, strides,
-                                               order)
-        # set the new 'info' attribute to the value passed
-        obj.counter = 0
-        obj.totalind = 0
-        obj.Fs = float(Fs)
-        obj.Ts = 1/obj.Fs
-        # Finally, we must return the newly created object:
-        return obj
-
-    def __array_finalize__(self, obj):
-        # see InfoArray.__array_finalize__ for comments
-        if obj is None:
-            return
-        self.bufferind = getattr(obj, 'bufferind', None)
+        self.Data = np.zeros((BufferSize, nChannels), dtype=dtype)
+        self.BufferSize = BufferSize
+        self.shape = self.Data.shape
+        self.dtype = self.Data.dtype
+        self.ndim = self.Data.ndim
+        self.WriteInd = 0
+        self.counter = 0
+        self.totalind = 0
+        # Samples overwritten before PopNew read them
+        self.Lost = 0
+        self.Fs = float(Fs)
+        self.Ts = 1/self.Fs
+        self.Cond = threading.Condition(threading.Lock())
 
     def AddData(self, NewData):
         newsize = NewData.shape[0]
-        self[0:-newsize, :] = self[newsize:, :]
-        self[-newsize:, :] = NewData
-        self.counter += newsize
-        self.totalind += newsize
+        with self.Cond:
+            self.counter += newsize
+            self.totalind += newsize
+            if newsize >= self.BufferSize:
+                self.Data[:, :] = NewData[newsize-self.BufferSize:, :]
+                self.WriteInd = 0
+            else:
+                stop = self.WriteInd + newsize
+                if stop <= self.BufferSize:
+                    self.Data[self.WriteInd:stop, :] = NewData
+                else:
+                    first = self.BufferSize - self.WriteInd
+                    self.Data[self.WriteInd:, :] = NewData[:first, :]
+                    self.Data[:stop-self.BufferSize, :] = NewData[first:, :]
+                self.WriteInd = stop % self.BufferSize
+            self.Cond.notify_all()
+
+    def _GetRows(self, start, stop):
+        # start, stop are chronological row indexes, 0 is the oldest sample
+        size = stop - start
+        start = (self.WriteInd + start) % max(self.BufferSize, 1)
+        stop = start + size
+        if stop <= self.BufferSize:
+            return self.Data[start:stop, :]
+        return np.concatenate((self.Data[start:, :],
+                               self.Data[:stop-self.BufferSize, :]))
+
+    def GetData(self, Size=None):
+        ''' Returns the last Size samples (all if None) in chronological
+            order. It is a view of the buffer unless the samples cross the
+            wrap point, in which case only those samples are copied.
+        '''
+        if Size is None or Size > self.BufferSize:
+            Size = self.BufferSize
+        return self._GetRows(self.BufferSize-Size, self.BufferSize)
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key, )
+        rows = key[0]
+        if isinstance(rows, slice) and rows.step in (None, 1):
+            start, stop, _ = rows.indices(self.BufferSize)
+            data = self._GetRows(start, max(start, stop))
+            return data[(slice(None), ) + key[1:]]
+        return self.GetData()[key]
+
+    def __array__(self, dtype=None, copy=None):
+        data = self.GetData()
+        if dtype is not None:
+            return data.astype(dtype)
+        return data
+
+    def __len__(self):
+        return self.BufferSize
+
+    def __getattr__(self, name):
+        # Any other ndarray attribute (transpose, mean, ...) is taken from
+        # the chronologically ordered data
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return getattr(self.GetData(), name)
 
     def IsFilled(self):
         return self.counter >= self.shape[0]
 
+    def WaitData(self, Size, Timeout=None):
+        ''' Blocks until Size samples have been added since the last Reset
+            or Timeout seconds elapse. Returns True if the samples are ready
+        '''
+        with self.Cond:
+            return self.Cond.wait_for(lambda: self.counter >= Size, Timeout)
+
+    def WaitFilled(self, Timeout=None):
+        return self.WaitData(self.shape[0], Timeout)
+
     def GetTimes(self, Size):
         stop = self.Ts * self.totalind
         start = stop - self.Ts*Size
@@ -188,7 +282,137 @@ class Buffer2D(np.ndarray):
         return times[-Size:]
 
     def Reset(self):
-        self.counter = 0
+        with self.Cond:
+            self.counter = 0
+
+    def PopNew(self):
+        ''' Returns a copy of the samples added since the last Reset or
+            PopNew and the number of samples lost before them, (data,
+            Lost). If more than the buffer length were added, only the
+            last BufferSize samples are returned, the older ones are
+            counted in Lost (and in self.Lost) and the data is not
+            contiguous with the previous call.
+        '''
+        with self.Cond:
+            Lost = max(self.counter - self.BufferSize, 0)
+            data = self.GetData(min(self.counter, self.BufferSize)).copy()
+            self.counter = 0
+            self.Lost += Lost
+        if Lost:
+            print('Buffer2D overflow, {} samples lost'.format(Lost))
+        return data, Lost
+
+
+class MinMaxLevel():
+    def __init__(self, Fs, nChannels, BufferSize, BinSize, Fact, dtype):
+        ''' One level of MinMaxPyramid, minimum and maximum of every
+            BinSize samples, computed from Fact values of the previous
+            level
+        '''
+        self.BinSize = BinSize
+        self.Fact = Fact
+        nBins = BufferSize//BinSize
+        self.Mins = Buffer2D(Fs/BinSize, nChannels, nBins*BinSize/Fs,
+                             dtype=dtype)
+        self.Maxs = Buffer2D(Fs/BinSize, nChannels, nBins*BinSize/Fs,
+                             dtype=dtype)
+        self.PendMin = np.zeros((0, nChannels), dtype=dtype)
+        self.PendMax = np.zeros((0, nChannels), dtype=dtype)
+
+    def AddData(self, Mins, Maxs):
+        ''' Adds values of the previous level, returns the new complete
+            bins (Mins, Maxs) of this level
+        '''
+        nChannels = Mins.shape[1]
+        Mins = np.concatenate((self.PendMin, Mins), axis=0)
+        Maxs = np.concatenate((self.PendMax, Maxs), axis=0)
+        nBins = Mins.shape[0]//self.Fact
+        nUsed = nBins*self.Fact
+        self.PendMin = Mins[nUsed:]
+        self.PendMax = Maxs[nUsed:]
+        Shape = (nBins, self.Fact, nChannels)
+        Mins = Mins[:nUsed].reshape(Shape).min(axis=1)
+        Maxs = Maxs[:nUsed].reshape(Shape).max(axis=1)
+        if nBins > 0:
+            self.Mins.AddData(Mins)
+            self.Maxs.AddData(Maxs)
+        return Mins, Maxs
+
+
+class MinMaxPyramid():
+    def __init__(self, Fs, nChannels, BufferSize, MaxPoints, dtype=float):
+        ''' Level-of-detail pyramid of a Buffer2D for plotting. Level k
+            keeps the minimum and maximum of every 4*2**k samples of the
+            last BufferSize samples. It is updated with the new samples
+            only, each level from the previous one. GetView returns about
+            MaxPoints points (min and max of each bin) from the coarsest
+            level that keeps them, so spikes are never lost and the cost
+            does not depend on the time shown. It has no lock, AddData
+            and GetView must be called from the same thread.
+            Fs: float. Sampling frequency
+            nChannels: int. Number of channels
+            BufferSize: int. Samples covered, as the Buffer2D
+            MaxPoints: int. Points per curve returned by GetView
+        '''
+        self.Fs = Fs
+        self.nChannels = nChannels
+        self.BufferSize = BufferSize
+        self.MaxPoints = MaxPoints
+        self.dtype = dtype
+        self.Reset()
+
+    def Reset(self, Offset=0):
+        ''' Empties the pyramid, the next sample added has the index
+            Offset
+        '''
+        self.Offset = Offset
+        self.nSamps = Offset
+        self.Levels = []
+        BinSize = 4
+        Fact = 4
+        while True:
+            self.Levels.append(MinMaxLevel(self.Fs, self.nChannels,
+                                           self.BufferSize, BinSize, Fact,
+                                           self.dtype))
+            if (2*self.BufferSize//BinSize <= self.MaxPoints or
+                    BinSize >= self.BufferSize):
+                break
+            BinSize *= 2
+            Fact = 2
+
+    def AddData(self, NewData, Lost=0):
+        ''' NewData: array (samples, nChannels). Lost: int. Samples missing
+            since the previous call, the pyramid restarts after them
+        '''
+        if Lost:
+            self.Reset(self.nSamps + Lost)
+        self.nSamps += NewData.shape[0]
+        Mins, Maxs = NewData, NewData
+        for Level in self.Levels:
+            Mins, Maxs = Level.AddData(Mins, Maxs)
+            if Mins.shape[0] == 0:
+                break
+
+    def GetView(self, ViewInd):
+        ''' Returns the sample index (float) and the values, interleaved
+            minimums and maximums (points, nChannels), of the last ViewInd
+            samples at the finest level with at most MaxPoints points
+        '''
+        for Level in self.Levels:
+            if 2*ViewInd//Level.BinSize <= self.MaxPoints:
+                break
+        B = Level.BinSize
+        nBins = min(ViewInd//B, Level.Mins.totalind, Level.Mins.BufferSize)
+        Data = np.empty((2*nBins, Level.Mins.shape[1]),
+                        dtype=Level.Mins.dtype)
+        Data[0::2, :] = Level.Mins.GetData(nBins)
+        Data[1::2, :] = Level.Maxs.GetData(nBins)
+        Start = self.Offset + (Level.Mins.totalind - nBins)*B
+        Inds = np.empty(2*nBins)
+        Inds[0::2] = Start + np.arange(nBins)*B
+        Inds[1::2] = Inds[0::2] + B/2
+        return Inds, Data
+
 
 ##############################################################################
 
@@ -197,23 +421,125 @@ labelStyle = {'color': '#FFF',
               'font-size': '7pt',
               'bold': True}
 
+# Maximum time (s) that a worker thread sleeps waiting for new data
+WaitTimeout = 0.1
+# Time (s) that stop waits for a worker thread before terminating it
+StopTimeout = 2.0
+
+
+class RenderScheduler(Qt.QObject):
+    def __init__(self, MaxFps=25):
+        ''' Draws from the GUI thread the data prepared by the plotter
+            threads. Workers call Post(Func, *args) with an already
+            computed array (a copy, not a view of a ring buffer), it only
+            replaces the pending call of the same Func. A QTimer runs the
+            pending calls at most MaxFps times per second, so only the
+            items with new data are redrawn and the drawing load does not
+            depend on the data rate. It must be created in the GUI thread.
+            MaxFps: float. Maximum refresh rate of the plots
+        '''
+        super(RenderScheduler, self).__init__()
+        self.Pending = {}
+        self.Lock = threading.Lock()
+        self.Frames = 0
+        self.Timer = Qt.QTimer()
+        self.Timer.timeout.connect(self.Render)
+        self.SetMaxFps(MaxFps)
+        self.Timer.start()
+
+    def SetMaxFps(self, MaxFps):
+        self.MaxFps = MaxFps
+        self.Timer.setInterval(int(1000/max(MaxFps, 0.1)))
+
+    def Post(self, Func, *args, **kwargs):
+        ''' Schedules Func(*args, **kwargs) for the next frame. Can be
+            called from any thread
+        '''
+        with self.Lock:
+            self.Pending.pop(Func, None)
+            self.Pending[Func] = (args, kwargs)
+
+    def Cancel(self, Funcs):
+        ''' Discards the pending calls of Funcs, used when a plot is closed
+        '''
+        with self.Lock:
+            for Func in Funcs:
+                self.Pending.pop(Func, None)
+
+    def Render(self):
+        with self.Lock:
+            Pending, self.Pending = self.Pending, {}
+        if not Pending:
+            return
+        for Func, (args, kwargs) in Pending.items():
+            Func(*args, **kwargs)
+        self.Frames += 1
+
+
+_RenderScheduler = None
+
+
+def GetRenderScheduler(MaxFps=None):
+    ''' Returns the RenderScheduler shared by all the plotters, created on
+        first use (from the GUI thread). MaxFps, if not None, sets its
+        refresh rate
+    '''
+    global _RenderScheduler
+    if _RenderScheduler is None:
+        _RenderScheduler = RenderScheduler()
+    if MaxFps is not None:
+        _RenderScheduler.SetMaxFps(MaxFps)
+    return _RenderScheduler
+
 
 class Plotter(Qt.QThread):
     def __init__(self, Fs, nChannels, ViewBuffer, ViewTime, RefreshTime,
-                 ChannelConf, ShowTime=True):
+                 ChannelConf, ShowTime=True, dtype=float, MaxPoints=0,
+                 MaxFps=None, RenderMode='PerChannel', ChannelOffset=0):
+        ''' The thread prepares the curves each RefreshTime and posts them
+            to the shared RenderScheduler, which draws them from the GUI
+            thread.
+            MaxPoints: int. If > 0, views longer than MaxPoints samples
+                            are drawn from a MinMaxPyramid with about
+                            MaxPoints points per curve
+            MaxFps: float. Maximum refresh rate of the RenderScheduler,
+                           unchanged if None
+            RenderMode: str. 'PerChannel' draws each channel as a curve.
+                             'Packed' draws all the channels of a window
+                             as a single curve (connect array), one paint
+                             call per window. The per-channel colors are
+                             lost, every channel of a window is drawn with
+                             the color of its first channel. There is no
+                             automatic downsampling, so it is meant to be
+                             used with MaxPoints
+            ChannelOffset: float. Vertical distance between consecutive
+                                  channels of a window
+        '''
         super(Plotter, self).__init__()
+        self.Running = True
 
         self.Winds = []
         self.nChannels = nChannels
         self.Plots = [None]*nChannels
         self.Curves = [None]*nChannels
+        self.RenderMode = RenderMode
+        # Packed mode, (curve, channel indexes) of each window
+        self.WinCurves = []
+        self.Offsets = np.zeros(nChannels, dtype=dtype)
 
         self.ShowTime = ShowTime
         self.Fs = Fs
         self.Ts = 1/float(self.Fs)
-        self.Buffer = Buffer2D(Fs, nChannels, ViewBuffer)
+        self.Buffer = Buffer2D(Fs, nChannels, ViewBuffer, dtype=dtype)
+        self.MaxPoints = MaxPoints
+        self.Pyramid = None
+        if MaxPoints > 0:
+            self.Pyramid = MinMaxPyramid(Fs, nChannels,
+                                         self.Buffer.BufferSize, MaxPoints,
+                                         dtype=dtype)
         self.SetRefreshTime(RefreshTime)
         self.SetViewTime(ViewTime)
+        self.Scheduler = GetRenderScheduler(MaxFps)
 
 #        print(self.RefreshInd, self.ViewInd, self.Buffer.shape)
 
@@ -237,20 +563,30 @@ class Plotter(Qt.QThread):
                        units='A',
                        **labelStyle)
 
-            p.setDownsampling(auto=True,
-                              mode='subsample',
-#                                  mode='peak',
-                              )
-            p.setClipToView(True)
-            # c = p.plot(pen=pg.mkPen(ch['color'],
-            for ch in chs:
-
-                c = p.plot(pen=pg.mkPen(ch['color'],
-                                        width=0.5))
-                                    # width=ch['width']))
-#                c = p.plot()
-                self.Plots[ch['Input']] = p
-                self.Curves[ch['Input']] = c
+            for k, ch in enumerate(chs):
+                self.Offsets[ch['Input']] = k*ChannelOffset
+            if RenderMode == 'Packed':
+                c = pg.PlotCurveItem(pen=pg.mkPen(chs[0]['color'],
+                                                  width=0.5))
+                p.addItem(c)
+                self.WinCurves.append((c, [ch['Input'] for ch in chs]))
+                for ch in chs:
+                    self.Plots[ch['Input']] = p
+            else:
+                if self.Pyramid is None:
+                    p.setDownsampling(auto=True,
+                                      mode='subsample',
+#                                      mode='peak',
+                                      )
+                p.setClipToView(True)
+                # c = p.plot(pen=pg.mkPen(ch['color'],
+                for ch in chs:
+                    c = p.plot(pen=pg.mkPen(ch['color'],
+                                            width=0.5))
+                                        # width=ch['width']))
+#                    c = p.plot()
+                    self.Plots[ch['Input']] = p
+                    self.Curves[ch['Input']] = c
 
             if xlink is not None:
                 p.setXLink(xlink)
@@ -270,34 +606,73 @@ class Plotter(Qt.QThread):
         self.RefreshInd = int(RefreshTime/self.Ts)
 
     def run(self, *args, **kwargs):
-        while True:
-            if self.Buffer.counter > self.RefreshInd:
-                if self.ShowTime:
-                    t = self.Buffer.GetTimes(self.ViewInd)
-                self.Buffer.Reset()
-                j = 0
-                for i in range(self.nChannels):
-                    j += 1e-6
+        while self.Running:
+            if self.Buffer.WaitData(self.RefreshInd + 1, WaitTimeout):
+                if self.Pyramid is not None:
+                    # Updated here, not in AddData, so the producer does
+                    # not pay for it and GetView sees a complete update
+                    NewData, Lost = self.Buffer.PopNew()
+                    self.Pyramid.AddData(NewData, Lost)
+                if (self.Pyramid is not None and
+                        self.ViewInd > self.MaxPoints):
+                    Inds, Data = self.Pyramid.GetView(self.ViewInd)
                     if self.ShowTime:
-                        self.Curves[i].setData(t, self.Buffer[-self.ViewInd:, i]+float(j))
-                        # self.Curves[i].setData(t, self.Buffer[-self.ViewInd:, i])
+                        x = Inds*self.Ts
+                    elif Inds.size:
+                        x = Inds - Inds[0]
                     else:
-                        # self.Curves[i].setData(self.Buffer[-self.ViewInd:, i]+int(j))
-                        self.Curves[i].setData(self.Buffer[-self.ViewInd:, i])
-#                    self.Curves[i].setData(NewData[:, i])
+                        x = Inds
+                    self.PostCurves(x, Data)
+                    continue
+                x = None
+                if self.ShowTime:
+                    x = self.Buffer.GetTimes(self.ViewInd)
+                self.Buffer.Reset()
+                self.PostCurves(x, self.Buffer[-self.ViewInd:, :])
 #                self.Plots[i].setXRange(self.BufferSize/10,
 #                                        self.BufferSize)
-            else:
-#                pg.QtGui.QApplication.processEvents()
-                Qt.QThread.msleep(10)
+
+    def PostCurves(self, x, Data):
+        ''' Posts the curves of Data (samples, nChannels) to the scheduler.
+            x: array. Abscissa, sample number if None
+        '''
+        if self.RenderMode != 'Packed':
+            for i in range(self.nChannels):
+                # The sum also copies the view of the buffer
+                y = Data[:, i] + self.Offsets[i]
+                if x is None:
+                    self.Scheduler.Post(self.Curves[i].setData, y)
+                else:
+                    self.Scheduler.Post(self.Curves[i].setData, x, y)
+            return
+        n = Data.shape[0]
+        if n == 0:
+            return
+        if x is None:
+            x = np.arange(n)
+        for c, Inputs in self.WinCurves:
+            y = (Data[:, Inputs] + self.Offsets[Inputs]).T.ravel()
+            # Breaks the line between the last and first points of channels
+            Connect = np.ones(y.size, dtype=bool)
+            Connect[n-1::n] = False
+            self.Scheduler.Post(c.setData, np.tile(x, len(Inputs)), y,
+                                connect=Connect)
 
     def AddData(self, NewData):
         self.Buffer.AddData(NewData)
 
     def stop(self):
+        # The loop ends after the update in process, terminate is only
+        # used if it does not finish in StopTimeout
+        self.Running = False
+        if not self.wait(int(StopTimeout*1000)):
+            self.terminate()
+            self.wait()
+        self.Scheduler.Cancel([c.setData for c in self.Curves
+                               if c is not None] +
+                              [c.setData for c, Inputs in self.WinCurves])
         for wind in self.Winds:
             wind.close()
-        self.terminate()
 
 
 ##############################################################################
@@ -333,9 +708,25 @@ PSDPars = ({'name': 'Fs',
             'type': 'float',
             'siPrefix': True,
             'suffix': 's'},
+           {'name': 'PSDMode',
+            'title': 'PSD Mode',
+            'type': 'list',
+            'values': ('Welch', 'Stream', 'StreamExp', 'MultiRes'),
+            'value': 'Welch'},
+           {'name': 'nFFTStage',
+            'title': 'MultiRes nFFT 2**x',
+            'type': 'int',
+            'value': 10,
+            'step': 1},
+           {'name': 'PointsPerDecade',
+            'title': 'Plot Points/Decade (0 Off)',
+            'type': 'int',
+            'limits': (0, 10000),
+            'value': 0},
            )
 
-PSDParsList = ('Fs', 'nFFT', 'nAvg', 'nChannels', 'scaling')
+PSDParsList = ('Fs', 'nFFT', 'nAvg', 'nChannels', 'scaling', 'PSDMode',
+               'nFFTStage', 'PointsPerDecade')
 
 
 class PSDParameters(pTypes.GroupParameter):
@@ -386,17 +777,316 @@ class PSDParameters(pTypes.GroupParameter):
         return PSDKwargs
 
 
+class PSDEngine():
+    def __init__(self, Fs, nFFT, scaling='density', Workers=-1):
+        ''' Welch PSD of multichannel data. The Hann window, the scale
+            factor and the frequency vector are computed once, the
+            segments are taken as a strided (segments, nFFT, channels)
+            view and transformed in a single rfft call. The result is the
+            same as scipy.signal.welch with the default arguments. Use
+            GetPSDEngine to share the engines with the same parameters.
+            Fs: float. Sampling frequency
+            nFFT: int. Segment length in samples
+            scaling: str. 'density' or 'spectrum'
+            Workers: int. Threads of scipy.fft.rfft, -1 for all the CPUs
+        '''
+        self.Fs = Fs
+        self.nFFT = nFFT
+        self.Step = nFFT - nFFT//2
+        self.Workers = Workers
+        self.Window = get_window('hann', nFFT)[:, None]
+        if scaling == 'density':
+            self.Scale = 1.0/(Fs*np.sum(self.Window**2))
+        else:
+            self.Scale = 1.0/np.sum(self.Window)**2
+        self.ff = np.fft.rfftfreq(nFFT, 1/Fs)
+
+    def Periodograms(self, Segs):
+        ''' Segs: array (nSegs, nFFT, nChannels). Returns the one-sided
+            periodogram of each segment (nSegs, nFreqs, nChannels)
+        '''
+        Segs = Segs - np.mean(Segs, axis=1, keepdims=True)
+        Segs *= self.Window.astype(Segs.dtype)
+        Spec = fft.rfft(Segs, axis=1, workers=self.Workers)
+        Pxx = np.square(Spec.real)
+        Pxx += np.square(Spec.imag)
+        Pxx *= 2*self.Scale
+        # DC and Nyquist bins are not doubled
+        Pxx[:, 0, :] /= 2
+        if self.nFFT % 2 == 0:
+            Pxx[:, -1, :] /= 2
+        return Pxx
+
+    def GetSegments(self, Data):
+        ''' Returns the strided view (nSegs, nFFT, nChannels) of the 50 %
+            overlapped segments of Data (samples, nChannels)
+        '''
+        Segs = sliding_window_view(Data, self.nFFT, axis=0)[::self.Step]
+        return Segs.transpose((0, 2, 1))
+
+    def Welch(self, Data):
+        ''' Data: array (samples, nChannels). Returns ff, psd
+            (nFreqs, nChannels) as welch(Data, Fs, nperseg=nFFT, axis=0)
+        '''
+        Pxx = self.Periodograms(self.GetSegments(np.asarray(Data)))
+        return self.ff, np.mean(Pxx, axis=0)
+
+
+_PSDEngines = {}
+
+
+def GetPSDEngine(Fs, nFFT, scaling='density'):
+    ''' Returns the PSDEngine of these parameters, created on first use
+    '''
+    Key = (float(Fs), int(nFFT), scaling)
+    if Key not in _PSDEngines:
+        _PSDEngines[Key] = PSDEngine(Fs, nFFT, scaling)
+    return _PSDEngines[Key]
+
+
+class StreamPSD():
+    def __init__(self, Fs, nFFT, nChannels, nAvg=4, scaling='density',
+                 Average='Mean'):
+        ''' Welch PSD estimator fed block by block. Each time a new
+            segment of nFFT samples (50 % overlap) is complete, it is
+            windowed and transformed, all channels in one rfft call, and
+            the average is updated. With Average='Mean' the result is the
+            same as welch over the last nFFT*nAvg samples.
+            Fs: float. Sampling frequency
+            nFFT: int. Segment length in samples
+            nChannels: int. Number of channels (columns)
+            nAvg: int. Length of the average, in nFFT samples. It
+                       spans 2*nAvg-1 overlapped segments
+            scaling: str. 'density' or 'spectrum', as welch
+            Average: str. 'Mean' averages the last 2*nAvg-1 segments,
+                          'Exp' is an exponential average with that time
+                          constant
+        '''
+        self.nFFT = nFFT
+        self.nChannels = nChannels
+        self.Engine = GetPSDEngine(Fs, nFFT, scaling)
+        self.Step = self.Engine.Step
+        self.ff = self.Engine.ff
+        self.nAvgSegs = max(2*nAvg - 1, 1)
+        self.Average = Average
+        self.Reset()
+
+    def Reset(self):
+        self.Pending = np.zeros((0, self.nChannels))
+        # Periodograms of the last segments (nAvgSegs, nFreqs, nChannels)
+        self.Segs = np.zeros((self.nAvgSegs, self.ff.size, self.nChannels))
+        self.SegInd = 0
+        self.nSegs = 0
+        self.psd = None
+
+    def AddData(self, NewData):
+        ''' Adds a block (samples, nChannels). Returns the number of new
+            segments included in the average
+        '''
+        Ext = np.concatenate((self.Pending, NewData), axis=0)
+        if Ext.shape[0] < self.nFFT:
+            self.Pending = Ext
+            return 0
+        Segs = self.Engine.GetSegments(Ext)
+        nNew = Segs.shape[0]
+        self.Pending = Ext[nNew*self.Step:]
+        Pxx = self.Engine.Periodograms(Segs)
+
+        if self.Average == 'Exp':
+            Alpha = 1.0/self.nAvgSegs
+            for P in Pxx:
+                if self.psd is None:
+                    self.psd = P.copy()
+                else:
+                    self.psd += Alpha*(P - self.psd)
+        else:
+            for P in Pxx[-self.nAvgSegs:]:
+                self.Segs[self.SegInd] = P
+                self.SegInd = (self.SegInd + 1) % self.nAvgSegs
+            nFilled = min(self.nSegs + nNew, self.nAvgSegs)
+            if nFilled == self.nAvgSegs:
+                self.psd = np.mean(self.Segs, axis=0)
+            else:
+                self.psd = np.mean(self.Segs[:nFilled], axis=0)
+        self.nSegs += nNew
+        return nNew
+
+    def DropPending(self):
+        ''' Discards the samples of the incomplete segment, used when the
+            next block is not contiguous
+        '''
+        self.Pending = np.zeros((0, self.nChannels))
+
+    def IsFilled(self):
+        return self.nSegs >= self.nAvgSegs
+
+    def GetPSD(self):
+        ''' Returns ff, psd (nFreqs, nChannels) as welch(axis=0)
+        '''
+        return self.ff, self.psd
+
+
+class MultiResPSD():
+    def __init__(self, Fs, nFFT, nChannels, nStages, nAvg=4,
+                 scaling='density'):
+        ''' Multi-resolution PSD. The data is decimated by 2 in nStages-1
+            cascaded stages and every stage has its own StreamPSD of nFFT
+            samples, so the resolution of stage k is Fs/2**k/nFFT with the
+            cost and memory of short segments. Each stage gives one
+            octave of the spectrum, the lowest stage gives all the
+            frequencies below, and GetPSD joins them in a single
+            log-spaced spectrum.
+            Fs: float. Sampling frequency
+            nFFT: int. Segment length of every stage
+            nChannels: int. Number of channels (columns)
+            nStages: int. Number of stages, the lowest frequency step is
+                          Fs/2**(nStages-1)/nFFT
+            nAvg, scaling: see StreamPSD. 'density' is recommended, with
+                           'spectrum' the level depends on the resolution
+                           of each stage
+        '''
+        self.nStages = max(int(nStages), 1)
+        self.nChannels = nChannels
+        self.Stages = []
+        self.Bands = []
+        for k in range(self.nStages):
+            FsStage = Fs/2**k
+            Stage = StreamPSD(FsStage, nFFT, nChannels, nAvg=nAvg,
+                              scaling=scaling)
+            self.Stages.append(Stage)
+            # Frequencies taken from each stage, the decimated stages are
+            # used up to the passband edge of the anti-alias filter
+            Top = FsStage/2 if k == 0 else 0.4*FsStage
+            Bottom = 0 if k == self.nStages-1 else 0.2*FsStage
+            self.Bands.append((Stage.ff > Bottom) & (Stage.ff <= Top))
+        self.Step = self.Stages[0].Step
+        # Elliptic anti-alias filter, passband 0.4*Fs ripple 0.01 dB and
+        # 90 dB of attenuation from 0.6*Fs (relative to each stage Nyquist)
+        self.sos = ellip(8, 0.01, 90, 0.4, output='sos')
+        self.Reset()
+
+    def Reset(self):
+        for Stage in self.Stages:
+            Stage.Reset()
+        self.zi = [np.zeros((self.sos.shape[0], 2, self.nChannels))
+                   for k in range(self.nStages-1)]
+        self.Phases = [0]*(self.nStages-1)
+
+    def AddData(self, NewData):
+        ''' Adds a block (samples, nChannels). Returns the number of new
+            segments of the first stage
+        '''
+        nNew = self.Stages[0].AddData(NewData)
+        Data = NewData
+        for k in range(self.nStages-1):
+            Filt, self.zi[k] = sosfilt(self.sos, Data, axis=0, zi=self.zi[k])
+            Data = Filt[self.Phases[k]::2]
+            self.Phases[k] = (self.Phases[k] + Filt.shape[0]) % 2
+            if Data.shape[0] == 0:
+                break
+            self.Stages[k+1].AddData(Data)
+        return nNew
+
+    def DropPending(self):
+        for Stage in self.Stages:
+            Stage.DropPending()
+
+    def IsFilled(self):
+        return self.Stages[-1].IsFilled()
+
+    def GetPSD(self):
+        ''' Returns ff, psd (nFreqs, nChannels) with the stages that already
+            have a spectrum, from the lowest frequency
+        '''
+        ff = []
+        psd = []
+        for Stage, Band in zip(self.Stages[::-1], self.Bands[::-1]):
+            if Stage.psd is None:
+                continue
+            ff.append(Stage.ff[Band])
+            psd.append(Stage.psd[Band, :])
+        return np.concatenate(ff), np.concatenate(psd, axis=0)
+
+
+class LogBinner():
+    def __init__(self, ff, PointsPerDecade):
+        ''' Averages a spectrum in log-spaced bands. The bins of each band
+            are found once, Apply only calls np.add.reduceat. At low
+            frequencies, where the bins are wider than the bands, every
+            bin is kept.
+            ff: array. Frequencies of the spectrum, increasing
+            PointsPerDecade: int. Number of bands per decade
+        '''
+        self.nIn = ff.size
+        Pos = np.nonzero(ff > 0)[0]
+        self.First = Pos[0]
+        fPos = ff[self.First:]
+        Edges = np.logspace(np.log10(fPos[0]), np.log10(fPos[-1]),
+                            int(np.ceil(np.log10(fPos[-1]/fPos[0]) *
+                                        PointsPerDecade)) + 1)
+        Band = np.searchsorted(Edges[1:-1], fPos, side='right')
+        # First bin of each non-empty band
+        self.Starts = np.concatenate(([0, ],
+                                      np.nonzero(np.diff(Band))[0] + 1))
+        self.Counts = np.diff(np.concatenate((self.Starts, [fPos.size, ])))
+        self.ff = np.add.reduceat(fPos, self.Starts)/self.Counts
+
+    def Apply(self, psd):
+        ''' psd: array (nFreqs, nChannels). Returns ff, psd of the bands
+        '''
+        Out = np.add.reduceat(psd[self.First:], self.Starts, axis=0)
+        Out /= self.Counts[:, None]
+        return self.ff, Out
+
+
 class PSDPlotter(Qt.QThread):
-    def __init__(self, Fs, nFFT, nAvg, nChannels, scaling, ChannelConf):
+    def __init__(self, Fs, nFFT, nAvg, nChannels, scaling, ChannelConf,
+                 dtype=float, PSDMode='Welch', nFFTStage=10,
+                 PointsPerDecade=0, MaxFps=None, **kwargs):
+        ''' PSDMode: str. 'Welch' computes the PSD (PSDEngine) each time
+                          the buffer of nFFT*nAvg samples is filled. 'Stream'
+                          and 'StreamExp' use StreamPSD and update the
+                          plot after each new segment, with the mean or
+                          the exponential average. 'MultiRes' uses
+                          MultiResPSD with segments of 2**nFFTStage
+                          samples and the stages needed to reach the
+                          resolution of 2**nFFT
+            nFFTStage: int. Segment length (2**x) of the MultiRes stages
+            PointsPerDecade: int. If > 0, the PSD is averaged in this
+                                  number of log-spaced bands per decade
+                                  before plotting (LogBinner)
+            MaxFps: float. Maximum refresh rate of the RenderScheduler,
+                           unchanged if None
+        '''
         super(PSDPlotter, self).__init__()
+        self.Running = True
 
         self.scaling = scaling
         self.nFFT = 2**nFFT
         self.nChannels = nChannels
         self.Fs = Fs
         self.BufferSize = self.nFFT * nAvg
+        if PSDMode == 'MultiRes':
+            # Only holds the samples waiting to be processed
+            self.BufferSize = min(self.BufferSize,
+                                  max(2**nFFTStage*nAvg, int(self.Fs)))
         self.Buffer = Buffer2D(self.Fs, self.nChannels,
-                               self.BufferSize/self.Fs)
+                               self.BufferSize/self.Fs, dtype=dtype)
+        self.PSDMode = PSDMode
+        self.PointsPerDecade = PointsPerDecade
+        self.Binner = None
+        self.Engine = GetPSDEngine(self.Fs, self.nFFT, scaling)
+        if PSDMode == 'MultiRes':
+            self.Stream = MultiResPSD(self.Fs, 2**nFFTStage, self.nChannels,
+                                      nStages=max(nFFT - nFFTStage, 0) + 1,
+                                      nAvg=nAvg, scaling=scaling)
+        elif PSDMode != 'Welch':
+            self.Stream = StreamPSD(self.Fs, self.nFFT, self.nChannels,
+                                    nAvg=nAvg, scaling=scaling,
+                                    Average='Exp' if PSDMode == 'StreamExp'
+                                    else 'Mean')
+
+        self.Scheduler = GetRenderScheduler(MaxFps)
 
         self.Plots = [None]*nChannels
         self.Curves = [None]*nChannels
@@ -419,24 +1109,268 @@ class PSDPlotter(Qt.QThread):
                 self.Curves[ch['Input']] = c
 
     def run(self, *args, **kwargs):
-        while True:
-            if self.Buffer.IsFilled():
-                ff, psd = welch(self.Buffer,
-                                fs=self.Fs,
-                                nperseg=self.nFFT,
-                                scaling=self.scaling,
-                                axis=0)
+        while self.Running:
+            if self.PSDMode != 'Welch':
+                if not self.Buffer.WaitData(self.Stream.Step, WaitTimeout):
+                    continue
+                Data, Lost = self.Buffer.PopNew()
+                if Lost:
+                    self.Stream.DropPending()
+                if not self.Stream.AddData(Data):
+                    continue
+                self.PlotPSD(*self.Stream.GetPSD())
+            elif self.Buffer.WaitFilled(WaitTimeout):
+                ff, psd = self.Engine.Welch(self.Buffer.GetData())
                 self.Buffer.Reset()
-                for i in range(self.nChannels):
-                    self.Curves[i].setData(ff, psd[:, i])
-            else:
-                Qt.QThread.msleep(10)
+                self.PlotPSD(ff, psd)
+
+    def PlotPSD(self, ff, psd):
+        if self.PointsPerDecade > 0:
+            # The frequencies only change while the MultiRes stages fill
+            if self.Binner is None or self.Binner.nIn != ff.size:
+                self.Binner = LogBinner(ff, self.PointsPerDecade)
+            ff, psd = self.Binner.Apply(psd)
+        for i in range(self.nChannels):
+            # The stream estimators update psd in place
+            self.Scheduler.Post(self.Curves[i].setData, ff, psd[:, i].copy())
 
     def AddData(self, NewData):
         self.Buffer.AddData(NewData)
 
     def stop(self):
+        # The loop ends after the update in process, terminate is only
+        # used if it does not finish in StopTimeout
+        self.Running = False
+        if not self.wait(int(StopTimeout*1000)):
+            self.terminate()
+            self.wait()
+        self.Scheduler.Cancel([c.setData for c in self.Curves])
         self.wind.close()
-        self.terminate()
 
 
+##############################################################################
+WaterfallPars = ({'name': 'Fs',
+                  'readonly': True,
+                  'type': 'float',
+                  'siPrefix': True,
+                  'suffix': 'Hz'},
+                 {'name': 'WaterfallEnable',
+                  'title': 'Waterfall Enable',
+                  'type': 'bool',
+                  'value': False},
+                 {'name': 'nFFT',
+                  'title': 'nFFT 2**x',
+                  'type': 'int',
+                  'value': 10,
+                  'step': 1},
+                 {'name': 'ViewTime',
+                  'type': 'float',
+                  'value': 60,
+                  'step': 10,
+                  'siPrefix': True,
+                  'suffix': 's'},
+                 {'name': 'FMax',
+                  'title': 'Max Frequency (0 Fs/2)',
+                  'type': 'float',
+                  'value': 0,
+                  'siPrefix': True,
+                  'suffix': 'Hz'},
+                 {'name': 'Channels',
+                  'title': 'Channels (empty all)',
+                  'type': 'str',
+                  'value': ''},
+                 )
+
+WaterfallParsList = ('Fs', 'nFFT', 'ViewTime', 'FMax', 'Channels')
+
+
+class WaterfallParameters(pTypes.GroupParameter):
+    def __init__(self, **kwargs):
+        pTypes.GroupParameter.__init__(self, **kwargs)
+
+        self.addChildren(WaterfallPars)
+
+    def GetParams(self):
+        ''' Returns a dictionary with the WaterfallPlotter arguments, the
+            channels are a list of names, None for all of them
+            {'Fs': 10000.0,
+             'nFFT': 10,
+             'ViewTime': 60,
+             'FMax': 0,
+             'Channels': ['Ch01Col1', 'Ch02Col1']}
+        '''
+        WaterfallKwargs = {}
+        for p in self.children():
+            if p.name() not in WaterfallParsList:
+                continue
+            WaterfallKwargs[p.name()] = p.value()
+        Chns = [c.strip() for c in WaterfallKwargs['Channels'].split(',')]
+        Chns = [c for c in Chns if c]
+        WaterfallKwargs['Channels'] = Chns if Chns else None
+        return WaterfallKwargs
+
+
+class WaterfallPlotter(Qt.QThread):
+    def __init__(self, Fs, nChannels, ChannelConf, nFFT=10, ViewTime=60,
+                 FMax=0, Channels=None, scaling='density', Levels=None,
+                 dtype=float, MaxFps=None, **kwargs):
+        ''' Rolling spectrogram of some channels. Every new segment of
+            2**nFFT samples (50 % overlap) gives one column per channel,
+            log10 of its periodogram mapped to 0-255. The columns are
+            written in a Buffer2D ring of ViewTime seconds and the thread
+            only posts the column count to the RenderScheduler. In the
+            GUI thread DrawColumns copies the new columns into a
+            persistent image of twice the length, each column at i and
+            i + nCols, so the chronological image is always a contiguous
+            view of it and no update copies the whole ViewTime.
+            Fs: float. Sampling frequency
+            nChannels: int. Number of channels of the added data
+            ChannelConf: dictionary. Channels configuration, as Plotter
+            nFFT: int. Segment length, 2**nFFT samples
+            ViewTime: float. Time shown (s)
+            FMax: float. Highest frequency shown, Fs/2 if 0
+            Channels: list. Names of the channels shown, all if None
+            scaling: str. 'density' or 'spectrum'
+            Levels: tuple. log10 PSD values of the first and last colors.
+                           If None, they are taken from the first columns
+                           that are not flat
+            MaxFps: float. Maximum refresh rate of the RenderScheduler,
+                           unchanged if None
+        '''
+        super(WaterfallPlotter, self).__init__()
+        self.Running = True
+
+        self.Fs = Fs
+        self.nFFT = 2**nFFT
+        self.Engine = GetPSDEngine(Fs, self.nFFT, scaling)
+        self.Step = self.Engine.Step
+        self.Buffer = Buffer2D(Fs, nChannels,
+                               max(4*self.nFFT, Fs*WaitTimeout*10)/Fs,
+                               dtype=dtype)
+        self.Pending = np.zeros((0, nChannels))
+
+        if FMax <= 0:
+            FMax = Fs/2
+        self.nFreqs = int(np.count_nonzero(self.Engine.ff <= FMax))
+        self.FMax = self.Engine.ff[self.nFreqs-1]
+        self.ColFs = Fs/self.Step
+        self.ViewTime = ViewTime
+        if Levels is not None and Levels[1] <= Levels[0]:
+            raise ValueError('Waterfall Levels must be increasing')
+        self.Levels = Levels
+
+        self.Inputs = []
+        Names = []
+        for win, chs in ChannelConf.items():
+            for ch in chs:
+                if Channels is None or ch['name'] in Channels:
+                    self.Inputs.append(ch['Input'])
+                    Names.append(ch['name'])
+        # One ring (columns, nFreqs) per channel
+        self.Images = [Buffer2D(self.ColFs, self.nFreqs, ViewTime,
+                                dtype=np.uint8)
+                       for i in self.Inputs]
+        self.nCols = self.Images[0].BufferSize if self.Images else 0
+        # Images shown, only used from the GUI thread
+        self.Shown = [np.zeros((2*self.nCols, self.nFreqs), dtype=np.uint8)
+                      for i in self.Inputs]
+        self.Drawn = [0]*len(self.Inputs)
+        self.Rect = Qt.QRectF(-ViewTime, 0, ViewTime, self.FMax)
+
+        self.Scheduler = GetRenderScheduler(MaxFps)
+        self.wind = PgPlotWindow()
+        self.ImageItems = []
+        Lut = pg.colormap.get('viridis').getLookupTable(nPts=256)
+        xlink = None
+        for Name in Names:
+            self.wind.pgLayout.nextRow()
+            p = self.wind.pgLayout.addPlot()
+            p.setLabel('left', Name, units='Hz', **labelStyle)
+            img = pg.ImageItem()
+            img.setLookupTable(Lut)
+            img.setLevels((0, 255))
+            p.addItem(img)
+            if xlink is not None:
+                p.setXLink(xlink)
+            xlink = p
+            self.ImageItems.append(img)
+        if xlink is not None:
+            xlink.setLabel('bottom', 'Time', units='s', **labelStyle)
+
+    def AddColumns(self, Data):
+        ''' Computes the columns of the complete segments of Data (samples,
+            nChannels) and adds them to the rings. Returns the number of
+            new columns
+        '''
+        Ext = np.concatenate((self.Pending, Data[:, self.Inputs]), axis=0)
+        if Ext.shape[0] < self.nFFT:
+            self.Pending = Ext
+            return 0
+        Segs = self.Engine.GetSegments(Ext)
+        nNew = Segs.shape[0]
+        self.Pending = Ext[nNew*self.Step:]
+        # (nNew, nFreqs, nInputs)
+        Pxx = self.Engine.Periodograms(Segs)[:, :self.nFreqs, :]
+        LogPxx = np.log10(np.maximum(Pxx, 1e-300))
+        if self.Levels is not None:
+            Low, High = self.Levels
+        else:
+            # Zeros before the acquisition settles do not fix the levels
+            Valid = LogPxx[Pxx > 0]
+            Low, High = LogPxx.min() - 1, LogPxx.min() + 1
+            if Valid.size:
+                Low = np.percentile(Valid, 1)
+                High = np.percentile(Valid, 99.9)
+                if High > Low:
+                    self.Levels = (float(Low), float(High))
+                else:
+                    Low, High = Low - 1, Low + 1
+        Cols = np.clip((LogPxx - Low)*(255/(High - Low)), 0, 255)
+        Cols = Cols.astype(np.uint8)
+        for i, Image in enumerate(self.Images):
+            Image.AddData(Cols[:, :, i])
+        return nNew
+
+    def run(self, *args, **kwargs):
+        while self.Running:
+            if not self.Buffer.WaitData(self.Step, WaitTimeout):
+                continue
+            Data, Lost = self.Buffer.PopNew()
+            if Lost:
+                self.Pending = self.Pending[:0]
+            if not self.AddColumns(Data):
+                continue
+            self.Scheduler.Post(self.DrawColumns)
+
+    def DrawColumns(self):
+        ''' Copies the columns added since the last call into the images
+            shown and updates them. Called from the GUI thread by the
+            RenderScheduler
+        '''
+        for i, (Image, img) in enumerate(zip(self.Images, self.ImageItems)):
+            with Image.Cond:
+                Total = Image.totalind
+                nNew = min(Total - self.Drawn[i], self.nCols)
+                Cols = Image.GetData(nNew).copy()
+            if nNew == 0:
+                continue
+            Pos = np.arange(Total - nNew, Total) % self.nCols
+            self.Shown[i][Pos] = Cols
+            self.Shown[i][Pos + self.nCols] = Cols
+            self.Drawn[i] = Total
+            Start = Total % self.nCols
+            img.setImage(self.Shown[i][Start:Start+self.nCols],
+                         autoLevels=False, rect=self.Rect)
+
+    def AddData(self, NewData):
+        self.Buffer.AddData(NewData)
+
+    def stop(self):
+        # The loop ends after the update in process, terminate is only
+        # used if it does not finish in StopTimeout
+        self.Running = False
+        if not self.wait(int(StopTimeout*1000)):
+            self.terminate()
+            self.wait()
+        self.Scheduler.Cancel([self.DrawColumns, ])
+        self.wind.close()
@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Bounded block queue used to pass acquired blocks from the producer (DAQ
+callback) to the consumer threads (saving, demodulation).
+"""
+
+import threading
+import collections
+
+
+QueuePolicies = ('Block', 'DropOldest', 'DropNewest')
+
+
+class BlockQueue():
+    def __init__(self, Depth=8, Policy='DropOldest'):
+        ''' Single producer / single consumer queue of data blocks.
+            Depth: int. Maximum number of pending blocks
+            Policy: str. What Put does when the queue is full
+                    'Block': waits until the consumer frees a slot
+                    'DropOldest': discards the oldest pending block
+                    'DropNewest': discards the block being added
+            The samples (len(Block)) dropped before each block are
+            counted, after Get the attribute Skipped has those of the
+            returned block, so the consumer can keep its time base.
+        '''
+        if Policy not in QueuePolicies:
+            raise ValueError('Unknown queue policy {}'.format(Policy))
+        self.Depth = max(int(Depth), 1)
+        self.Policy = Policy
+        self.Blocks = collections.deque()
+        # Samples dropped before each pending block and before the next
+        # block that will be added
+        self.Gaps = collections.deque()
+        self.NextGap = 0
+        self.Skipped = 0
+        self.Cond = threading.Condition(threading.Lock())
+        self.Added = 0
+        self.Dropped = 0
+        self.MaxLevel = 0
+
+    def Put(self, Block):
+        ''' Adds a block to the queue, returns False if a block was dropped
+        '''
+        Ok = True
+        with self.Cond:
+            if len(self.Blocks) >= self.Depth:
+                if self.Policy == 'Block':
+                    while len(self.Blocks) >= self.Depth:
+                        self.Cond.wait()
+                elif self.Policy == 'DropOldest':
+                    Gap = self.Gaps.popleft() + len(self.Blocks.popleft())
+                    if self.Gaps:
+                        self.Gaps[0] += Gap
+                    else:
+                        self.NextGap += Gap
+                    self.Dropped += 1
+                    Ok = False
+                else:
+                    self.NextGap += len(Block)
+                    self.Dropped += 1
+                    return False
+            self.Blocks.append(Block)
+            self.Gaps.append(self.NextGap)
+            self.NextGap = 0
+            self.Added += 1
+            self.MaxLevel = max(self.MaxLevel, len(self.Blocks))
+            self.Cond.notify_all()
+        return Ok
+
+    def Get(self, Timeout=0):
+        ''' Returns the oldest pending block or None if the queue is still
+            empty after Timeout seconds (0 returns at once, None waits
+            until a block arrives)
+        '''
+        with self.Cond:
+            if not self.Blocks and Timeout != 0:
+                self.Cond.wait_for(lambda: self.Blocks, Timeout)
+            if not self.Blocks:
+                return None
+            Block = self.Blocks.popleft()
+            self.Skipped = self.Gaps.popleft()
+            self.Cond.notify_all()
+        return Block
+
+    def Clear(self):
+        ''' Discards the pending blocks, without counting them as dropped
+            samples
+        '''
+        with self.Cond:
+            self.Blocks.clear()
+            self.Gaps.clear()
+            self.NextGap = 0
+            self.Cond.notify_all()
+
+    def Level(self):
+        return len(self.Blocks)
+
+    def GetCounters(self):
+        ''' Returns a dictionary with the queue statistics
+            {'Added': 1200,
+             'Dropped': 2,
+             'Pending': 0,
+             'MaxLevel': 5}
+        '''
+        return {'Added': self.Added,
+                'Dropped': self.Dropped,
+                'Pending': len(self.Blocks),
+                'MaxLevel': self.MaxLevel}
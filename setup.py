@@ -16,6 +16,7 @@ long_description = """
 
 install_requires = [
                     'numpy',
+                    'h5py',
                     'PyDAQmx',
                     'matplotlib',
                     'quantities>=0.12',
@@ -24,6 +25,8 @@ install_requires = [
                     ]
 
 console_scripts = [
+                   'OfflineDemod = PyqtTools.OfflineDemodModule:main',
+                   'DemodBenchmark = PyqtTools.BenchmarkModule:main',
                   ]
 
 entry_points = {'console_scripts': console_scripts, }